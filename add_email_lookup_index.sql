@@ -0,0 +1,9 @@
+-- Index friend lookups by email case-insensitively so add_friend_by_email
+-- can match 'Alice@Example.com' against 'alice@example.com' without a scan.
+-- callback() stores emails lowercase; backfill older rows first. The index
+-- is unique so a lookup can never match two profiles (resolve any rows
+-- that differ only by case before running this).
+update profiles set email = lower(email) where email <> lower(email);
+
+drop index if exists idx_profiles_email_lower;
+create unique index idx_profiles_email_lower on profiles(lower(email));
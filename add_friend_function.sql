@@ -0,0 +1,26 @@
+-- Create function to add a friend by email in a single round trip
+-- Returns 'not_found', 'exists' or 'added'
+-- Runs as the caller (security invoker) so RLS on profiles and friendships
+-- still applies, exactly as it did for the separate client queries
+create or replace function add_friend_by_email(uid uuid, femail text)
+returns text as $$
+declare
+    fid uuid;
+begin
+    -- lower(email) matches idx_profiles_email_lower
+    select id into fid from profiles where lower(email) = lower(femail);
+    if fid is null then
+        return 'not_found';
+    end if;
+
+    insert into friendships (user_id, friend_id, created_at)
+    values (uid, fid, now())
+    on conflict do nothing;
+
+    if not found then
+        return 'exists';
+    end if;
+
+    return 'added';
+end;
+$$ language plpgsql security invoker set search_path = public;
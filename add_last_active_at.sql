@@ -0,0 +1,6 @@
+-- Track when each profile last used the app so the background worker only
+-- refreshes recently active users
+alter table profiles
+    add column last_active_at timestamp with time zone default now();
+
+create index idx_profiles_last_active_at on profiles(last_active_at desc);
@@ -0,0 +1,9 @@
+-- The app signs users in through its own Oura OAuth flow, not Supabase Auth,
+-- so auth.uid() is always null and "Users can update own profile" matched no
+-- rows. callback()'s upsert on oura_user_id then failed the policy check for
+-- every returning user. Allow updates the same way oura_tokens does.
+drop policy if exists "Users can update own profile" on profiles;
+
+create policy "Users can update profiles"
+    on profiles for update
+    using (true);
@@ -0,0 +1,26 @@
+-- Create table for leaderboard scores aggregated by background.py
+create table sleep_leaderboard (
+    profile_id uuid primary key references profiles(id) on delete cascade,
+    latest_score integer not null default 0,
+    avg_score numeric(4, 1) not null default 0,
+    num_days integer not null default 0,
+    updated_at timestamp with time zone default now()
+);
+
+-- Dashboard reads the leaderboard ordered by average score
+create index idx_sleep_leaderboard_avg_score on sleep_leaderboard(avg_score desc);
+
+alter table sleep_leaderboard enable row level security;
+
+create policy "Anyone can read the sleep leaderboard"
+    on sleep_leaderboard for select
+    using (true);
+
+-- The worker and callback() upsert with the app key, like oura_tokens
+create policy "Anyone can create the sleep leaderboard"
+    on sleep_leaderboard for insert
+    with check (true);
+
+create policy "Anyone can update the sleep leaderboard"
+    on sleep_leaderboard for update
+    using (true);
@@ -0,0 +1,7 @@
+-- Store HTTP validators from the last Oura daily_sleep fetch so the
+-- background worker can send conditional requests. validators_url records
+-- the date window they belong to; they are not sent for any other URL
+alter table sleep_leaderboard
+    add column etag text,
+    add column last_modified text,
+    add column validators_url text;
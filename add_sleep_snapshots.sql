@@ -0,0 +1,23 @@
+-- Create table for daily sleep scores ingested by background.py
+create table daily_sleep_snapshots (
+    profile_id uuid references profiles(id) on delete cascade,
+    day date not null,
+    score integer,
+    updated_at timestamp with time zone default now(),
+    primary key (profile_id, day)
+);
+
+alter table daily_sleep_snapshots enable row level security;
+
+create policy "Anyone can read sleep snapshots"
+    on daily_sleep_snapshots for select
+    using (true);
+
+-- The worker upserts with the app key, like oura_tokens
+create policy "Anyone can create sleep snapshots"
+    on daily_sleep_snapshots for insert
+    with check (true);
+
+create policy "Anyone can update sleep snapshots"
+    on daily_sleep_snapshots for update
+    using (true);
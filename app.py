@@ -1,43 +1,274 @@
-from flask import Flask, redirect, request, session, url_for, render_template_string
+from flask import Flask, redirect, request, session, url_for, render_template, make_response, g
+from flask.json.provider import DefaultJSONProvider
+from flask_caching import Cache
+from flask_compress import Compress
+from jinja2 import FileSystemBytecodeCache
 from oura import OuraOAuth2Client
-from dotenv import load_dotenv
 import os
-import traceback
-import requests
-import json
-from datetime import datetime, timedelta
-from supabase import create_client, Client
-from functools import wraps
-from cryptography.fernet import Fernet
+import hashlib
+import logging
+import secrets
+import orjson
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from functools import wraps, lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+# Importing core loads the environment, configures logging and builds the
+# shared Oura session and Supabase client
+from core import (
+    supabase,
+    execute_read,
+    oura_session,
+    oura_headers,
+    encrypt_token,
+    remember_decrypted_token,
+    get_date_range,
+    get_token_row,
+    get_valid_access_token,
+    client_id,
+    client_secret,
+    OURA_TIMEOUT,
+    OURA_TOKEN_URL,
+    PERSONAL_INFO_URL,
+    DAILY_SLEEP_URL,
+    DAILY_READINESS_URL
+)
+from ingestion import ingest_new_user
 
-# Load environment variables
-load_dotenv()
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson, falling back to stdlib for custom options."""
+    
+    def dumps(self, obj, **kwargs):
+        # Flask passes these itself: jsonify sends indent=2 or compact
+        # separators, the session serializer separators and |tojson sort_keys.
+        # Anything orjson can't express goes to the stdlib encoder
+        indent = kwargs.get('indent')
+        separators = kwargs.get('separators', (',', ':'))
+        sort_keys = kwargs.get('sort_keys', self.sort_keys)
+        if kwargs.keys() - {'indent', 'separators', 'sort_keys'} or indent not in (None, 2) or tuple(separators) != (',', ':'):
+            return super().dumps(obj, **kwargs)
+        # Match DefaultJSONProvider: allow non-str keys and hand dates to
+        # self.default so they stay HTTP dates. orjson output is already compact
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+    
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.secret_key = os.getenv('FLASK_SECRET_KEY')
 
+# Templates are compiled once and served from Jinja's cache in production;
+# the bytecode cache lets every worker process skip recompiling them.
+# Loading bytecode executes it, so by default Jinja picks its own per-user
+# temp directory, which it creates 0700 and checks ownership of. An explicit
+# JINJA_CACHE_DIR must not be writable by any other user
+JINJA_CACHE_DIR = os.getenv('JINJA_CACHE_DIR')
+if os.getenv('FLASK_ENV') == 'production':
+    app.config['TEMPLATES_AUTO_RELOAD'] = False
+    app.jinja_env.auto_reload = False
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
+
+# Unversioned static URLs are only cached briefly; URLs carrying the file's
+# content hash are cache-busted, so browsers and CDNs may keep them for a year
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 300
+VERSIONED_STATIC_MAX_AGE = 31536000
+# The unversioned React shell is only cached briefly
+REACT_SHELL_MAX_AGE = 60
+
+# Response compression for the HTML pages and any JSON responses
+app.config['COMPRESS_MIMETYPES'] = ['text/html', 'text/css', 'application/json']
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+Compress(app)
+
 # OAuth2 Configuration
-client_id = os.getenv('OURA_CLIENT_ID')
-client_secret = os.getenv('OURA_CLIENT_SECRET')
 redirect_uri = os.getenv('OURA_REDIRECT_URI')
+OAUTH_SCOPES = ["personal", "daily", "heartrate", "workout", "session", "sleep"]
 
-# Encryption Configuration
-encryption_key = os.getenv('ENCRYPTION_KEY').encode()
-fernet = Fernet(encryption_key)
-
-# Supabase Configuration
-supabase: Client = create_client(
-    os.getenv('SUPABASE_URL'),
-    os.getenv('SUPABASE_KEY')
-)
-
-def encrypt_token(token: str) -> str:
-    """Encrypt a token using Fernet encryption."""
-    return fernet.encrypt(token.encode()).decode()
-
-def decrypt_token(encrypted_token: str) -> str:
-    """Decrypt a token using Fernet encryption."""
-    return fernet.decrypt(encrypted_token.encode()).decode()
+def build_authorize_url_base() -> str:
+    """Build the Oura authorize URL once, without the per-request state parameter."""
+    auth_client = OuraOAuth2Client(client_id=client_id, client_secret=client_secret)
+    auth_endpoint_result = auth_client.authorize_endpoint(
+        redirect_uri=redirect_uri,
+        scope=OAUTH_SCOPES
+    )
+    
+    # Handle both tuple and string responses
+    if isinstance(auth_endpoint_result, tuple):
+        auth_url = auth_endpoint_result[0]
+    else:
+        auth_url = auth_endpoint_result
+    
+    parts = urlsplit(auth_url)
+    query = [(key, value) for key, value in parse_qsl(parts.query) if key != 'state']
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+# Scope and redirect URI are fixed, so the authorize URL only varies by state
+AUTHORIZE_URL_BASE = build_authorize_url_base()
+
+# Cache Configuration
+# Redis is shared across workers; SimpleCache is per process, so with several
+# workers clear_dashboard_cache() would only reach the one that handled the
+# callback. Production runs multiple gunicorn workers and must set REDIS_URL
+DASHBOARD_CACHE_TIMEOUT = 300
+PERSONAL_INFO_CACHE_TIMEOUT = 86400
+OURA_DATA_CACHE_TIMEOUT = 900
+if os.getenv('FLASK_ENV') == 'production' and not os.getenv('REDIS_URL'):
+    raise RuntimeError("REDIS_URL is required in production: the page cache must be shared by all workers")
+if os.getenv('REDIS_URL'):
+    cache = Cache(app, config={
+        'CACHE_TYPE': 'RedisCache',
+        'CACHE_REDIS_URL': os.getenv('REDIS_URL'),
+        'CACHE_DEFAULT_TIMEOUT': DASHBOARD_CACHE_TIMEOUT
+    })
+else:
+    cache = Cache(app, config={
+        'CACHE_TYPE': 'SimpleCache',
+        'CACHE_DEFAULT_TIMEOUT': DASHBOARD_CACHE_TIMEOUT
+    })
+
+# Number of users shown on the dashboard leaderboard
+LEADERBOARD_SIZE = 50
+# Rows the background worker has not refreshed within this window belong to
+# users it no longer tracks, so their averages are left off the leaderboard
+LEADERBOARD_MAX_AGE = timedelta(days=1)
+
+# Worker pool for issuing independent Oura requests concurrently, sized for
+# the concurrent dashboard renders each gevent worker serves
+OURA_EXECUTOR_WORKERS = 32
+oura_executor = ThreadPoolExecutor(max_workers=OURA_EXECUTOR_WORKERS)
+
+def get_personal_info(access_token: str):
+    """Fetch Oura personal info, cached per access token for 24 hours."""
+    cache_key = 'oura_pi:' + hashlib.sha256(access_token.encode()).hexdigest()[:16]
+    personal_info = cache.get(cache_key)
+    if personal_info is not None:
+        return personal_info
+    
+    response = oura_session.get(
+        PERSONAL_INFO_URL,
+        headers=oura_headers(access_token),
+        timeout=OURA_TIMEOUT
+    )
+    if response.status_code != 200:
+        app.logger.warning("Error fetching personal info: %s", response.text)
+        return None
+    
+    personal_info = orjson.loads(response.content)
+    cache.set(cache_key, personal_info, timeout=PERSONAL_INFO_CACHE_TIMEOUT)
+    return personal_info
+
+def get_cached_oura_data(profile_id: str, url: str, access_token: str):
+    """Fetch an Oura collection URL for a profile, caching successful responses."""
+    # The URL already encodes the endpoint and date window
+    cache_key = f"oura:{profile_id}:{url}"
+    data = cache.get(cache_key)
+    if data is not None:
+        return data
+    
+    response = oura_session.get(url, headers=oura_headers(access_token), timeout=OURA_TIMEOUT)
+    if response.status_code != 200:
+        return None
+    
+    data = orjson.loads(response.content)
+    cache.set(cache_key, data, timeout=OURA_DATA_CACHE_TIMEOUT)
+    return data
+
+def clear_cached_oura_data(profile_id: str) -> None:
+    """Drop a profile's cached sleep and readiness data for the current date window."""
+    start_date, end_date = get_date_range()
+    cache.delete_many(*(
+        f"oura:{profile_id}:{url.format(start_date=start_date, end_date=end_date)}"
+        for url in (DAILY_SLEEP_URL, DAILY_READINESS_URL)
+    ))
+
+def index_by_day(collection: dict) -> dict:
+    """Map each entry of an Oura daily collection response by its 'day'."""
+    return {entry['day']: entry for entry in collection.get('data', [])}
+
+
+@lru_cache(maxsize=None)
+def static_file_hash(filename: str) -> str:
+    """Short content hash of a static file, computed once per process."""
+    with open(os.path.join(app.static_folder, filename), 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()[:8]
+
+@app.template_global()
+def static_url(filename: str) -> str:
+    """URL for a static file with a content hash so it can be cached indefinitely."""
+    return url_for('static', filename=filename, v=static_file_hash(filename))
+
+@app.after_request
+def mark_versioned_static_immutable(response):
+    """Let browsers keep content-hashed static files without revalidating."""
+    # Only when the version matches the file actually served; a stale or
+    # made-up 'v' keeps the short default lifetime
+    if (request.endpoint == 'static' and response.status_code in (200, 304)
+            and request.args.get('v') == static_file_hash(request.view_args['filename'])):
+        response.cache_control.max_age = VERSIONED_STATIC_MAX_AGE
+        response.cache_control.immutable = True
+    return response
+
+def touch_last_active(profile_id: str) -> None:
+    """Mark a profile as recently active so the background worker keeps refreshing it."""
+    try:
+        result = supabase.table('profiles')\
+            .update({'last_active_at': datetime.now(timezone.utc).isoformat()}, count='exact', returning='minimal')\
+            .eq('id', profile_id)\
+            .execute()
+        if not result.count:
+            # Missing profile or an update policy that filters the row out;
+            # either way the worker would stop refreshing this user
+            app.logger.warning("last_active_at was not updated for profile %s", profile_id)
+    except Exception as e:
+        app.logger.error("Error updating last_active_at for profile %s: %s", profile_id, e)
+
+def build_leaderboard_entry(row: dict, current_profile_id: str) -> dict:
+    """Turn a sleep_leaderboard row into the shape the dashboard template expects."""
+    return {
+        'user_id': row['profile_id'],
+        'display_name': row['profiles']['display_name'],
+        'latest_score': row['latest_score'],
+        'avg_score': row['avg_score'],
+        'is_current_user': row['profile_id'] == current_profile_id,
+        'num_days': row['num_days']
+    }
+
+def dashboard_cache_key(*args, **kwargs):
+    """Cache key for the logged-in user's rendered dashboard."""
+    return f"dashboard:{session['profile_id']}"
+
+def is_cacheable_response(response) -> bool:
+    """Only cache successfully rendered pages, not redirects, error tuples or fallback pages."""
+    return isinstance(response, str) and not g.get('rendered_from_fallback')
+
+def dashboard_etag_key(profile_id: str) -> str:
+    """Cache key for the ETag of a profile's dashboard in the current date window."""
+    start_date, end_date = get_date_range()
+    return f"dashboard_etag:{profile_id}:{start_date}:{end_date}"
+
+def current_dashboard_etag_key() -> str:
+    """ETag cache key for the logged-in user's dashboard."""
+    return dashboard_etag_key(session['profile_id'])
+
+def clear_dashboard_cache(profile_id: str) -> None:
+    """Drop a profile's rendered dashboard and its ETag so the next load re-renders."""
+    cache.delete_many(f"dashboard:{profile_id}", dashboard_etag_key(profile_id))
+
+def etag_matches(etag: str) -> bool:
+    """Check If-None-Match, allowing for the ':<algorithm>' suffix Flask-Compress appends."""
+    return any(
+        tag == etag or tag.startswith(f"{etag}:")
+        for tag in request.if_none_match.as_set(include_weak=True)
+    )
 
 # Login required decorator
 def login_required(f):
@@ -48,6 +279,35 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# Conditional GET decorator: the ETag is a hash of the last page served, kept
+# in the cache under make_etag_key() for as long as the rendered page is
+def etag_conditional(make_etag_key):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            etag_key = make_etag_key()
+            etag = cache.get(etag_key)
+            if etag and etag_matches(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200 or g.get('rendered_from_fallback'):
+                    # Never let a redirect, error or fallback page be revalidated
+                    cache.delete(etag_key)
+                    return response
+                etag = hashlib.sha1(response.get_data()).hexdigest()
+                cache.set(etag_key, etag, timeout=DASHBOARD_CACHE_TIMEOUT)
+                if etag_matches(etag):
+                    # Re-rendered to the same page the browser already has
+                    response = make_response('', 304)
+            response.set_etag(etag)
+            # Per-user page: browsers must revalidate, shared caches must not store it
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return decorated_function
+    return decorator
+
 @app.route('/')
 def index():
     """Home page with login link."""
@@ -62,21 +322,7 @@ def index():
 @app.route('/login')
 def login():
     """Initiate OAuth2 flow."""
-    auth_client = OuraOAuth2Client(client_id=client_id, client_secret=client_secret)
-    
-    # Get the authorization URL
-    auth_endpoint_result = auth_client.authorize_endpoint(
-        redirect_uri=redirect_uri,
-        scope=["personal", "daily", "heartrate", "workout", "session", "sleep"]
-    )
-    
-    # Handle both tuple and string responses
-    if isinstance(auth_endpoint_result, tuple):
-        auth_url = auth_endpoint_result[0]
-    else:
-        auth_url = auth_endpoint_result
-        
-    return redirect(auth_url)
+    return redirect(f"{AUTHORIZE_URL_BASE}&state={secrets.token_urlsafe(16)}")
 
 @app.route('/callback')
 def callback():
@@ -87,7 +333,6 @@ def callback():
 
     try:
         # Exchange code for tokens
-        token_url = "https://api.ouraring.com/oauth/token"
         payload = {
             'grant_type': 'authorization_code',
             'code': code,
@@ -96,522 +341,152 @@ def callback():
             'client_secret': client_secret
         }
         
-        response = requests.post(token_url, data=payload)
+        response = oura_session.post(OURA_TOKEN_URL, data=payload, timeout=OURA_TIMEOUT)
         if response.status_code != 200:
             return f'Error during token exchange: {response.text}', 400
         
-        token_dict = response.json()
+        token_dict = orjson.loads(response.content)
         
         # Get user info from Oura
-        headers = {
-            'Authorization': f'Bearer {token_dict["access_token"]}',
-            'Content-Type': 'application/json'
-        }
-        user_info_response = requests.get(
-            "https://api.ouraring.com/v2/usercollection/personal_info",
-            headers=headers
-        )
-        
-        if user_info_response.status_code != 200:
-            return f'Error fetching user info: {user_info_response.text}', 400
-        
-        user_info = user_info_response.json()
+        user_info = get_personal_info(token_dict['access_token'])
+        if user_info is None:
+            return 'Error fetching user info from Oura', 400
         
         # Generate display name from email
         email = user_info.get('email')
         display_name = email.split('@')[0] if email else f"User_{datetime.now().strftime('%y%m%d%H%M%S')}"
-        
-        # Check if profile exists
-        existing_profile = supabase.table('profiles').select('*').eq('oura_user_id', user_info.get('id')).execute()
-        
-        if existing_profile.data:
-            # Update existing profile
-            profile_id = existing_profile.data[0]['id']
-            supabase.table('profiles').update({
-                'email': email,
-                'display_name': display_name
-            }).eq('id', profile_id).execute()
-        else:
-            # Create new profile
-            profile_result = supabase.table('profiles').insert({
-                'oura_user_id': user_info.get('id'),
-                'email': email,
-                'display_name': display_name
-            }).execute()
-            profile_id = profile_result.data[0]['id']
+        # Emails are stored lowercase so they stay unique case-insensitively
+        if email:
+            email = email.lower()
+        
+        # Create or update profile in a single round trip (oura_user_id is unique)
+        profile_result = supabase.table('profiles').upsert({
+            'oura_user_id': user_info.get('id'),
+            'email': email,
+            'display_name': display_name,
+            'last_active_at': datetime.now(timezone.utc).isoformat()
+        }, on_conflict='oura_user_id', returning='representation').execute()
+        profile_id = profile_result.data[0]['id']
         
         # Store/update tokens
+        access_token_encrypted = encrypt_token(token_dict['access_token'])
         token_data = {
             'profile_id': profile_id,
-            'access_token_encrypted': encrypt_token(token_dict['access_token']),
+            'access_token_encrypted': access_token_encrypted,
             'refresh_token_encrypted': encrypt_token(token_dict['refresh_token']) if token_dict.get('refresh_token') else None,
-            'expires_at': (datetime.now() + timedelta(seconds=token_dict['expires_in'])).isoformat(),
+            'expires_at': (datetime.now(timezone.utc) + timedelta(seconds=token_dict['expires_in'])).isoformat(),
             'scopes': ','.join(token_dict.get('scope', '').split(' '))
         }
         
-        # Upsert tokens
-        existing_tokens = supabase.table('oura_tokens').select('*').eq('profile_id', profile_id).execute()
-        if existing_tokens.data:
-            supabase.table('oura_tokens').update(token_data).eq('profile_id', profile_id).execute()
-        else:
-            supabase.table('oura_tokens').insert(token_data).execute()
+        # Upsert tokens in a single round trip (profile_id is unique)
+        supabase.table('oura_tokens').upsert(token_data, on_conflict='profile_id', returning='minimal').execute()
+        
+        # The dashboard redirect reads this ciphertext back; skip decrypting it again
+        remember_decrypted_token(access_token_encrypted, token_dict['access_token'])
         
-        # Store profile_id in session
+        # Seed leaderboard scores before redirecting, so the first dashboard
+        # render (which is then cached) already includes this user
+        ingest_new_user({
+            'id': profile_id,
+            'display_name': display_name,
+            'oura_tokens': token_data
+        })
+        
+        # New tokens mean the cached dashboard, its ETag and Oura data are stale
+        clear_dashboard_cache(profile_id)
+        clear_cached_oura_data(profile_id)
+        
+        # Store only profile_id in session; everything else is looked up server-side
         session['profile_id'] = profile_id
-        session['oura_user_id'] = user_info.get('id')
         
         return redirect(url_for('dashboard'))
     except Exception as e:
-        print(f"Error during callback: {str(e)}")
-        print(traceback.format_exc())
+        app.logger.exception("Error during callback")
         return f'Error during callback: {str(e)}', 400
 
 @app.route('/dashboard')
 @login_required
+@etag_conditional(current_dashboard_etag_key)
+@cache.cached(
+    timeout=DASHBOARD_CACHE_TIMEOUT,
+    make_cache_key=dashboard_cache_key,
+    response_filter=is_cacheable_response
+)
 def dashboard():
     """Display user's Oura Ring data and global leaderboard."""
     try:
         # Calculate date range for sleep data
-        end_date = datetime.now().strftime('%Y-%m-%d')
-        start_date = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
+        start_date, end_date = get_date_range()
+        sleep_url = DAILY_SLEEP_URL.format(start_date=start_date, end_date=end_date)
         
-        # Get user's profile and tokens
-        profile = supabase.table('profiles').select('*').eq('id', session['profile_id']).execute()
+        # Get user's profile and token in a single embedded select
+        profile = execute_read(supabase.table('profiles')\
+            .select('id, display_name, oura_tokens(access_token_encrypted, refresh_token_encrypted, expires_at)')\
+            .eq('id', session['profile_id']))
         if not profile.data:
             return redirect(url_for('login'))
         
-        # Get all users and their tokens for the leaderboard
-        all_users_with_tokens = supabase.table('profiles')\
-            .select('*, oura_tokens(*)')\
-            .execute()
-            
-        # Prepare leaderboard data
-        leaderboard_data = []
-        
-        for user in all_users_with_tokens.data:
-            try:
-                if not user['oura_tokens']:
-                    continue
-                    
-                # Decrypt token
-                token = decrypt_token(user['oura_tokens'][0]['access_token_encrypted'])
-                
-                headers = {
-                    'Authorization': f'Bearer {token}',
-                    'Content-Type': 'application/json'
-                }
-                
-                sleep_response = requests.get(
-                    f"https://api.ouraring.com/v2/usercollection/daily_sleep?start_date={start_date}&end_date={end_date}",
-                    headers=headers
-                )
-                
-                if sleep_response.status_code == 200:
-                    sleep_data = sleep_response.json()
-                    # Print debug info to understand data structure
-                    print(f"Sleep data for {user['display_name']}: {json.dumps(sleep_data, indent=2)}")
-                    
-                    # Get all valid scores from the data, sorted by date (most recent first)
-                    daily_sleep = sleep_data.get('data', [])
-                    daily_sleep.sort(key=lambda x: x['day'], reverse=True)  # Sort by date, newest first
-                    scores = []
-                    
-                    for day in daily_sleep:
-                        # Get the sleep score directly from the day data
-                        score = day.get('score', None)
-                        
-                        if score is not None:
-                            scores.append(score)
-                            print(f"Found score {score} for day {day['day']}")
-                    
-                    # Print debug info
-                    print(f"User {user['display_name']} - Valid scores found: {scores}")
-                    
-                    # Calculate scores
-                    latest_score = scores[0] if scores else 0  # Most recent score
-                    avg_score = round(sum(scores) / len(scores), 1) if scores else 0
-                    
-                    print(f"User {user['display_name']} - Latest: {latest_score}, Average: {avg_score}")
-                    
-                    leaderboard_data.append({
-                        'user_id': user['id'],
-                        'display_name': user['display_name'],
-                        'latest_score': int(latest_score),  # Convert to integer for cleaner display
-                        'avg_score': avg_score,
-                        'is_current_user': user['id'] == session['profile_id'],
-                        'num_days': len(scores)  # Track how many days of data we have
-                    })
-                else:
-                    # Add user to leaderboard even if API call fails
-                    leaderboard_data.append({
-                        'user_id': user['id'],
-                        'display_name': user['display_name'],
-                        'latest_score': 0,
-                        'avg_score': 0,
-                        'is_current_user': user['id'] == session['profile_id'],
-                        'num_days': 0  # Add num_days field
-                    })
-                        
-            except Exception as e:
-                print(f"Error fetching data for user {user['display_name']}: {str(e)}")
-                # Add user to leaderboard even if there's an error
-                leaderboard_data.append({
-                    'user_id': user['id'],
-                    'display_name': user['display_name'],
-                    'latest_score': 0,
-                    'avg_score': 0,
-                    'is_current_user': user['id'] == session['profile_id'],
-                    'num_days': 0  # Add num_days field
-                })
-        
-        # Sort leaderboard by average score
-        leaderboard_data.sort(key=lambda x: x['avg_score'], reverse=True)
-        
-        # Get current user's sleep data for detailed view
-        tokens = supabase.table('oura_tokens').select('*').eq('profile_id', session['profile_id']).execute()
-        if not tokens.data:
+        token_row = get_token_row(profile.data[0])
+        if not token_row:
             return redirect(url_for('login'))
         
-        access_token = decrypt_token(tokens.data[0]['access_token_encrypted'])
-        
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
-        }
-        
-        # Get personal info
-        personal_info_response = requests.get(
-            "https://api.ouraring.com/v2/usercollection/personal_info",
-            headers=headers
-        )
-        personal_info = personal_info_response.json()
+        # Record activity without holding up the render
+        oura_executor.submit(touch_last_active, session['profile_id'])
+        
+        # Read the pre-aggregated leaderboard maintained by the background worker,
+        # limited to recently refreshed profiles that still have an Oura Ring connected
+        fresh_since = (datetime.now(timezone.utc) - LEADERBOARD_MAX_AGE).isoformat()
+        leaderboard = execute_read(supabase.table('sleep_leaderboard')\
+            .select('profile_id, latest_score, avg_score, num_days, profiles!inner(display_name, oura_tokens!inner(id))')\
+            .gte('updated_at', fresh_since)\
+            .order('avg_score', desc=True)\
+            .limit(LEADERBOARD_SIZE))
+        
+        leaderboard_data = [
+            build_leaderboard_entry(row, session['profile_id'])
+            for row in leaderboard.data
+        ]
+        
+        # Get current user's sleep data for detailed view, refreshing the token
+        # up front instead of waiting for Oura to answer 401
+        access_token = get_valid_access_token(session['profile_id'], token_row)
+        if access_token is None:
+            return redirect(url_for('login'))
         
-        # Get sleep data for the last 7 days
-        sleep_response = requests.get(
-            f"https://api.ouraring.com/v2/usercollection/daily_sleep?start_date={start_date}&end_date={end_date}",
-            headers=headers
+        # Get personal info, sleep and readiness data for the last 7 days concurrently
+        personal_info_future = oura_executor.submit(get_personal_info, access_token)
+        sleep_future = oura_executor.submit(
+            get_cached_oura_data,
+            session['profile_id'],
+            sleep_url,
+            access_token
         )
-        sleep_data = sleep_response.json()
-
-        # Get readiness data
-        readiness_response = requests.get(
-            f"https://api.ouraring.com/v2/usercollection/daily_readiness?start_date={start_date}&end_date={end_date}",
-            headers=headers
+        readiness_future = oura_executor.submit(
+            get_cached_oura_data,
+            session['profile_id'],
+            DAILY_READINESS_URL.format(start_date=start_date, end_date=end_date),
+            access_token
         )
-        readiness_data = readiness_response.json()
-        print(f"Readiness data: {json.dumps(readiness_data, indent=2)}")
-
-        return render_template_string('''
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <title>Oura Ring Dashboard</title>
-                <style>
-                    body { font-family: Arial, sans-serif; margin: 20px; }
-                    .container { max-width: 1200px; margin: 0 auto; }
-                    .card { 
-                        border: 1px solid #ddd; 
-                        padding: 20px; 
-                        margin: 10px 0; 
-                        border-radius: 8px;
-                        box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-                    }
-                    .sleep-grid {
-                        display: grid;
-                        grid-template-columns: repeat(auto-fill, minmax(300px, 1fr));
-                        gap: 20px;
-                    }
-                    .metric {
-                        margin: 10px 0;
-                    }
-                    .progress-bar {
-                        background-color: #e9ecef;
-                        border-radius: 10px;
-                        height: 15px;
-                        overflow: hidden;
-                        margin: 0 10px;
-                    }
-                    .progress-bar-fill {
-                        background-color: #4CAF50;
-                        height: 100%;
-                        transition: width 0.3s ease;
-                    }
-                    .readiness-metric {
-                        display: flex;
-                        align-items: center;
-                        margin: 8px 0;
-                        padding: 5px;
-                        border-radius: 4px;
-                        background-color: white;
-                    }
-                    .readiness-label {
-                        width: 160px;
-                        font-weight: 500;
-                        color: #333;
-                    }
-                    .readiness-value {
-                        margin-left: 10px;
-                        min-width: 40px;
-                        text-align: right;
-                        font-weight: bold;
-                    }
-                    .metric-group {
-                        margin-bottom: 20px;
-                        padding: 15px;
-                        border-radius: 8px;
-                        background-color: #f8f9fa;
-                    }
-                    h3 { 
-                        color: #2c3e50;
-                        margin-bottom: 15px;
-                        font-size: 1.2em;
-                    }
-                    .date-header {
-                        display: flex;
-                        justify-content: space-between;
-                        align-items: center;
-                        margin-bottom: 15px;
-                        padding-bottom: 10px;
-                        border-bottom: 1px solid #eee;
-                    }
-                    .score-badge {
-                        background-color: #4CAF50;
-                        color: white;
-                        padding: 5px 15px;
-                        border-radius: 20px;
-                        font-weight: bold;
-                        font-size: 0.9em;
-                    }
-                    .leaderboard {
-                        margin-top: 30px;
-                    }
-                    .leaderboard-table {
-                        width: 100%;
-                        border-collapse: collapse;
-                        margin-top: 10px;
-                    }
-                    .leaderboard-table th,
-                    .leaderboard-table td {
-                        padding: 12px;
-                        text-align: left;
-                        border-bottom: 1px solid #ddd;
-                    }
-                    .leaderboard-table th {
-                        background-color: #f5f5f5;
-                        font-weight: bold;
-                    }
-                    .leaderboard-table tr:hover {
-                        background-color: #f9f9f9;
-                    }
-                    .current-user {
-                        background-color: #e8f5e9;
-                    }
-                    .medal {
-                        display: inline-block;
-                        width: 20px;
-                        height: 20px;
-                        border-radius: 50%;
-                        margin-right: 5px;
-                        text-align: center;
-                        color: white;
-                        font-weight: bold;
-                    }
-                    .gold { background-color: #FFD700; }
-                    .silver { background-color: #C0C0C0; }
-                    .bronze { background-color: #CD7F32; }
-                    button {
-                        padding: 8px 16px;
-                        background-color: #4CAF50;
-                        color: white;
-                        border: none;
-                        border-radius: 4px;
-                        cursor: pointer;
-                    }
-                    button:hover {
-                        background-color: #45a049;
-                    }
-                    .logout {
-                        float: right;
-                        background-color: #f44336;
-                    }
-                    .logout:hover {
-                        background-color: #da190b;
-                    }
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <div class="card">
-                        <a href="{{ url_for('logout') }}" class="logout">Logout</a>
-                        <h1>Your Oura Ring Dashboard</h1>
-                        <p>Welcome, {{ profile.data[0].display_name }}!</p>
-                    </div>
-
-                    <div class="sleep-grid">
-                    {% for day in sleep_data.get('data', []) %}
-                        <div class="card">
-                            <div class="date-header">
-                                <h3>{{ day['day'] }}</h3>
-                                <span class="score-badge">Score: {{ day.get('score', 0) }}</span>
-                            </div>
-
-                            <div class="metric-group">
-                                <h3>Sleep Metrics</h3>
-                                {% for metric, value in day['contributors'].items() %}
-                                <div class="metric">
-                                    {{ metric.replace('_', ' ').title() }}: {{ value }}
-                                    <div class="progress-bar">
-                                        <div class="progress-bar-fill" style="width: {{ value }}%"></div>
-                                    </div>
-                                </div>
-                                {% endfor %}
-                            </div>
-
-                            {% for readiness_day in readiness_data.get('data', []) %}
-                                {% if readiness_day['day'] == day['day'] %}
-                                <div class="metric-group">
-                                    <h3>Readiness Metrics</h3>
-                                    
-                                    <!-- Main Readiness Score -->
-                                    <div class="readiness-metric">
-                                        <span class="readiness-label">Readiness Score:</span>
-                                        <div class="progress-bar" style="flex-grow: 1;">
-                                            <div class="progress-bar-fill" style="width: {{ readiness_day.get('score', 0) }}%"></div>
-                                        </div>
-                                        <span class="readiness-value">{{ readiness_day.get('score', 0) }}</span>
-                                    </div>
-
-                                    <!-- Activity Balance -->
-                                    <div class="readiness-metric">
-                                        <span class="readiness-label">Activity Balance:</span>
-                                        <div class="progress-bar" style="flex-grow: 1;">
-                                            <div class="progress-bar-fill" style="width: {{ readiness_day.get('contributors', {}).get('activity_balance', 0) }}%"></div>
-                                        </div>
-                                        <span class="readiness-value">{{ readiness_day.get('contributors', {}).get('activity_balance', 0) }}</span>
-                                    </div>
-
-                                    <!-- Body Temperature -->
-                                    <div class="readiness-metric">
-                                        <span class="readiness-label">Body Temperature:</span>
-                                        <div class="progress-bar" style="flex-grow: 1;">
-                                            <div class="progress-bar-fill" style="width: {{ readiness_day.get('contributors', {}).get('body_temperature', 0) }}%"></div>
-                                        </div>
-                                        <span class="readiness-value">{{ readiness_day.get('contributors', {}).get('body_temperature', 0) }}</span>
-                                    </div>
-
-                                    <!-- HRV Balance -->
-                                    <div class="readiness-metric">
-                                        <span class="readiness-label">HRV Balance:</span>
-                                        <div class="progress-bar" style="flex-grow: 1;">
-                                            <div class="progress-bar-fill" style="width: {{ readiness_day.get('contributors', {}).get('hrv_balance', 0) }}%"></div>
-                                        </div>
-                                        <span class="readiness-value">{{ readiness_day.get('contributors', {}).get('hrv_balance', 0) }}</span>
-                                    </div>
-
-                                    <!-- Previous Day Activity -->
-                                    <div class="readiness-metric">
-                                        <span class="readiness-label">Previous Day Activity:</span>
-                                        <div class="progress-bar" style="flex-grow: 1;">
-                                            <div class="progress-bar-fill" style="width: {{ readiness_day.get('contributors', {}).get('previous_day_activity', 0) }}%"></div>
-                                        </div>
-                                        <span class="readiness-value">{{ readiness_day.get('contributors', {}).get('previous_day_activity', 0) }}</span>
-                                    </div>
-
-                                    <!-- Previous Night -->
-                                    <div class="readiness-metric">
-                                        <span class="readiness-label">Previous Night:</span>
-                                        <div class="progress-bar" style="flex-grow: 1;">
-                                            <div class="progress-bar-fill" style="width: {{ readiness_day.get('contributors', {}).get('previous_night', 0) }}%"></div>
-                                        </div>
-                                        <span class="readiness-value">{{ readiness_day.get('contributors', {}).get('previous_night', 0) }}</span>
-                                    </div>
-
-                                    <!-- Recovery Index -->
-                                    <div class="readiness-metric">
-                                        <span class="readiness-label">Recovery Index:</span>
-                                        <div class="progress-bar" style="flex-grow: 1;">
-                                            <div class="progress-bar-fill" style="width: {{ readiness_day.get('contributors', {}).get('recovery_index', 0) }}%"></div>
-                                        </div>
-                                        <span class="readiness-value">{{ readiness_day.get('contributors', {}).get('recovery_index', 0) }}</span>
-                                    </div>
-
-                                    <!-- Resting Heart Rate -->
-                                    <div class="readiness-metric">
-                                        <span class="readiness-label">Resting Heart Rate:</span>
-                                        <div class="progress-bar" style="flex-grow: 1;">
-                                            <div class="progress-bar-fill" style="width: {{ readiness_day.get('contributors', {}).get('resting_heart_rate', 0) }}%"></div>
-                                        </div>
-                                        <span class="readiness-value">{{ readiness_day.get('contributors', {}).get('resting_heart_rate', 0) }}</span>
-                                    </div>
-
-                                    <!-- Sleep Balance -->
-                                    <div class="readiness-metric">
-                                        <span class="readiness-label">Sleep Balance:</span>
-                                        <div class="progress-bar" style="flex-grow: 1;">
-                                            <div class="progress-bar-fill" style="width: {{ readiness_day.get('contributors', {}).get('sleep_balance', 0) }}%"></div>
-                                        </div>
-                                        <span class="readiness-value">{{ readiness_day.get('contributors', {}).get('sleep_balance', 0) }}</span>
-                                    </div>
-                                </div>
-                                {% endif %}
-                            {% endfor %}
-                        </div>
-                    {% endfor %}
-                    </div>
-
-                    <div class="card leaderboard">
-                        <h2>Global Sleep Score Leaderboard</h2>
-                        <p>See how your sleep compares with others!</p>
-                        <table class="leaderboard-table">
-                            <thead>
-                                <tr>
-                                    <th>Rank</th>
-                                    <th>User</th>
-                                    <th>Latest Sleep Score</th>
-                                    <th>7-Day Average</th>
-                                </tr>
-                            </thead>
-                            <tbody>
-                                {% for user in leaderboard_data %}
-                                <tr {% if user.is_current_user %}class="current-user"{% endif %}>
-                                    <td>
-                                        {% if loop.index == 1 %}
-                                        <span class="medal gold">1</span>
-                                        {% elif loop.index == 2 %}
-                                        <span class="medal silver">2</span>
-                                        {% elif loop.index == 3 %}
-                                        <span class="medal bronze">3</span>
-                                        {% else %}
-                                        {{ loop.index }}
-                                        {% endif %}
-                                    </td>
-                                    <td>
-                                        <a href="/user/{{ user.user_id }}" style="text-decoration: underline; color: #2563eb;">
-                                            {{ user.display_name }}
-                                        </a>
-                                    </td>
-                                    <td>{{ user.latest_score }}</td>
-                                    <td>
-                                        {{ user.avg_score }}
-                                        {% if user.num_days > 0 %}
-                                        <small style="color: #666">({{ user.num_days }} days)</small>
-                                        {% else %}
-                                        <small style="color: #999">(no data)</small>
-                                        {% endif %}
-                                    </td>
-                                </tr>
-                                {% endfor %}
-                            </tbody>
-                        </table>
-                    </div>
-                </div>
-            </body>
-            </html>
-        ''', profile=profile, personal_info=personal_info, sleep_data=sleep_data, leaderboard_data=leaderboard_data, readiness_data=readiness_data)
+        personal_info = personal_info_future.result()
+        sleep_data = sleep_future.result()
+        readiness_data = readiness_future.result()
+        if personal_info is None or sleep_data is None or readiness_data is None:
+            # Oura failed; render what we have but keep the page out of the
+            # page cache and ETag so the next load retries
+            g.rendered_from_fallback = True
+        sleep_data = sleep_data or {'data': []}
+        readiness_data = readiness_data or {'data': []}
+        # Lazy %s formatting keeps the payload from being rendered unless DEBUG is on
+        if app.logger.isEnabledFor(logging.DEBUG):
+            app.logger.debug("Readiness data: %s", readiness_data)
+
+        # Index readiness by day so the template looks each day up directly
+        readiness_by_day = index_by_day(readiness_data)
+
+        return render_template('dashboard.html', profile=profile, personal_info=personal_info, sleep_data=sleep_data, leaderboard_data=leaderboard_data, readiness_by_day=readiness_by_day)
         
     except Exception as e:
-        print(f"Error in dashboard: {str(e)}")
-        print(traceback.format_exc())
+        app.logger.exception("Error in dashboard")
         return f'Error in dashboard: {str(e)}', 400
 
 @app.route('/add_friend', methods=['POST'])
@@ -623,33 +498,20 @@ def add_friend():
         return 'Email is required', 400
     
     try:
-        # Find friend by email
-        friend = supabase.table('profiles').select('*').eq('email', friend_email).execute()
-        if not friend.data:
-            return 'Friend not found. They need to connect their Oura Ring first!', 404
-        
-        friend_id = friend.data[0]['id']
+        # Look up friend, check for duplicates and insert in one round trip
+        result = supabase.rpc('add_friend_by_email', {
+            'uid': session['profile_id'],
+            'femail': friend_email
+        }).execute()
         
-        # Check if friendship already exists
-        existing = supabase.table('friendships').select('*')\
-            .eq('user_id', session['profile_id'])\
-            .eq('friend_id', friend_id)\
-            .execute()
-            
-        if existing.data:
+        if result.data == 'not_found':
+            return 'Friend not found. They need to connect their Oura Ring first!', 404
+        if result.data == 'exists':
             return 'Already friends with this user', 400
         
-        # Create friendship
-        supabase.table('friendships').insert({
-            'user_id': session['profile_id'],
-            'friend_id': friend_id,
-            'created_at': datetime.now().isoformat()
-        }).execute()
-        
         return redirect(url_for('dashboard'))
     except Exception as e:
-        print(f"Error adding friend: {str(e)}")
-        print(traceback.format_exc())
+        app.logger.exception("Error adding friend")
         return f'Error adding friend: {str(e)}', 400
 
 @app.route('/logout')
@@ -663,7 +525,7 @@ def check_tables():
     """Check what tables exist in Supabase."""
     try:
         # List all tables
-        tables = supabase.table('profiles').select('*').execute()
+        tables = supabase.table('profiles').select('id, display_name').execute()
         return f'Tables exist and can be queried: {tables.data}'
     except Exception as e:
         return f'Error checking tables: {str(e)}'
@@ -673,254 +535,59 @@ def check_tables():
 def user_profile(user_id):
     """Get a user's profile data including sleep and readiness metrics."""
     try:
-        # Get user's profile
-        profile = supabase.table('profiles').select('*').eq('id', user_id).execute()
+        # Get user's profile and token in a single embedded select
+        profile = execute_read(supabase.table('profiles')\
+            .select('id, display_name, oura_tokens(access_token_encrypted, refresh_token_encrypted, expires_at)')\
+            .eq('id', user_id))
         if not profile.data:
             return 'User not found', 404
 
-        # Get user's tokens
-        tokens = supabase.table('oura_tokens').select('*').eq('profile_id', user_id).execute()
-        if not tokens.data:
-            return render_template_string('''
-                <!DOCTYPE html>
-                <html>
-                <head>
-                    <title>User Profile</title>
-                    <style>
-                        body { font-family: Arial, sans-serif; margin: 20px; }
-                        .container { max-width: 800px; margin: 0 auto; }
-                        .card { 
-                            border: 1px solid #ddd; 
-                            padding: 20px; 
-                            margin: 10px 0; 
-                            border-radius: 8px;
-                            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-                        }
-                    </style>
-                </head>
-                <body>
-                    <div class="container">
-                        <div class="card">
-                            <h1>{{ display_name }}'s Profile</h1>
-                            <p>This user hasn't connected their Oura Ring yet.</p>
-                            <a href="/dashboard">Back to Dashboard</a>
-                        </div>
-                    </div>
-                </body>
-                </html>
-            ''', display_name=profile.data[0]['display_name'])
+        token_row = get_token_row(profile.data[0])
+        if not token_row:
+            return render_template('user_not_connected.html', display_name=profile.data[0]['display_name'])
 
         # Calculate date range for last 7 days
-        end_date = datetime.now().strftime('%Y-%m-%d')
-        start_date = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
-
-        # Get access token
-        access_token = decrypt_token(tokens.data[0]['access_token_encrypted'])
-        
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'Content-Type': 'application/json'
-        }
-        
-        # Get sleep data
-        sleep_response = requests.get(
-            f"https://api.ouraring.com/v2/usercollection/daily_sleep?start_date={start_date}&end_date={end_date}",
-            headers=headers
+        start_date, end_date = get_date_range()
+
+        # Get access token, refreshing it first if it is about to expire
+        access_token = get_valid_access_token(user_id, token_row)
+        if access_token is None:
+            # Still connected, but the token could not be refreshed; show the
+            # profile with no data rather than claiming they never connected
+            return render_template('user_profile.html', profile=profile, sleep_data={'data': []}, readiness_by_day={})
+        
+        # Fetch sleep and readiness data concurrently; both share oura_session's pool
+        sleep_future = oura_executor.submit(
+            get_cached_oura_data,
+            user_id,
+            DAILY_SLEEP_URL.format(start_date=start_date, end_date=end_date),
+            access_token
         )
-        
-        sleep_data = {'data': []}
-        if sleep_response.status_code == 200:
-            sleep_data = sleep_response.json()
-        
-        # Get readiness data
-        readiness_response = requests.get(
-            f"https://api.ouraring.com/v2/usercollection/daily_readiness?start_date={start_date}&end_date={end_date}",
-            headers=headers
+        readiness_future = oura_executor.submit(
+            get_cached_oura_data,
+            user_id,
+            DAILY_READINESS_URL.format(start_date=start_date, end_date=end_date),
+            access_token
         )
-        
-        readiness_data = {'data': []}
-        if readiness_response.status_code == 200:
-            readiness_data = readiness_response.json()
-
-        return render_template_string('''
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <title>{{ profile.data[0].display_name }}'s Profile</title>
-                <style>
-                    body { font-family: Arial, sans-serif; margin: 20px; }
-                    .container { max-width: 1200px; margin: 0 auto; }
-                    .card { 
-                        border: 1px solid #ddd; 
-                        padding: 20px; 
-                        margin: 10px 0; 
-                        border-radius: 8px;
-                        box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-                    }
-                    .sleep-grid {
-                        display: grid;
-                        grid-template-columns: repeat(auto-fill, minmax(300px, 1fr));
-                        gap: 20px;
-                    }
-                    .metric {
-                        margin: 10px 0;
-                    }
-                    .progress-bar {
-                        background-color: #e9ecef;
-                        border-radius: 10px;
-                        height: 15px;
-                        overflow: hidden;
-                        margin: 0 10px;
-                    }
-                    .progress-bar-fill {
-                        background-color: #4CAF50;
-                        height: 100%;
-                        transition: width 0.3s ease;
-                    }
-                    .readiness-metric {
-                        display: flex;
-                        align-items: center;
-                        margin: 8px 0;
-                        padding: 5px;
-                        border-radius: 4px;
-                        background-color: white;
-                    }
-                    .readiness-label {
-                        width: 160px;
-                        font-weight: 500;
-                        color: #333;
-                    }
-                    .readiness-value {
-                        margin-left: 10px;
-                        min-width: 40px;
-                        text-align: right;
-                        font-weight: bold;
-                    }
-                    .metric-group {
-                        margin-bottom: 20px;
-                        padding: 15px;
-                        border-radius: 8px;
-                        background-color: #f8f9fa;
-                    }
-                    h3 { 
-                        color: #2c3e50;
-                        margin-bottom: 15px;
-                        font-size: 1.2em;
-                    }
-                    .date-header {
-                        display: flex;
-                        justify-content: space-between;
-                        align-items: center;
-                        margin-bottom: 15px;
-                        padding-bottom: 10px;
-                        border-bottom: 1px solid #eee;
-                    }
-                    .score-badge {
-                        background-color: #4CAF50;
-                        color: white;
-                        padding: 5px 15px;
-                        border-radius: 20px;
-                        font-weight: bold;
-                        font-size: 0.9em;
-                    }
-                    .back-button {
-                        display: inline-block;
-                        padding: 8px 16px;
-                        background-color: #4CAF50;
-                        color: white;
-                        text-decoration: none;
-                        border-radius: 4px;
-                        margin-bottom: 20px;
-                    }
-                    .back-button:hover {
-                        background-color: #45a049;
-                    }
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <a href="/dashboard" class="back-button">← Back to Dashboard</a>
-                    
-                    <div class="card">
-                        <h1>{{ profile.data[0].display_name }}'s Profile</h1>
-                    </div>
-
-                    <div class="sleep-grid">
-                    {% for day in sleep_data.get('data', []) %}
-                        <div class="card">
-                            <div class="date-header">
-                                <h3>{{ day['day'] }}</h3>
-                                <span class="score-badge">Score: {{ day.get('score', 0) }}</span>
-                            </div>
-
-                            <div class="metric-group">
-                                <h3>Sleep Metrics</h3>
-                                {% for metric, value in day['contributors'].items() %}
-                                <div class="metric">
-                                    {{ metric.replace('_', ' ').title() }}: {{ value }}
-                                    <div class="progress-bar">
-                                        <div class="progress-bar-fill" style="width: {{ value }}%"></div>
-                                    </div>
-                                </div>
-                                {% endfor %}
-                            </div>
-
-                            {% for readiness_day in readiness_data.get('data', []) %}
-                                {% if readiness_day['day'] == day['day'] %}
-                                <div class="metric-group">
-                                    <h3>Readiness Metrics</h3>
-                                    
-                                    <!-- Main Readiness Score -->
-                                    <div class="readiness-metric">
-                                        <span class="readiness-label">Readiness Score:</span>
-                                        <div class="progress-bar" style="flex-grow: 1;">
-                                            <div class="progress-bar-fill" style="width: {{ readiness_day.get('score', 0) }}%"></div>
-                                        </div>
-                                        <span class="readiness-value">{{ readiness_day.get('score', 0) }}</span>
-                                    </div>
-
-                                    {% for metric, value in readiness_day['contributors'].items() %}
-                                    <div class="readiness-metric">
-                                        <span class="readiness-label">{{ metric.replace('_', ' ').title() }}:</span>
-                                        <div class="progress-bar" style="flex-grow: 1;">
-                                            <div class="progress-bar-fill" style="width: {{ value }}%"></div>
-                                        </div>
-                                        <span class="readiness-value">{{ value }}</span>
-                                    </div>
-                                    {% endfor %}
-                                </div>
-                                {% endif %}
-                            {% endfor %}
-                        </div>
-                    {% endfor %}
-                    </div>
-                </div>
-            </body>
-            </html>
-        ''', profile=profile, sleep_data=sleep_data, readiness_data=readiness_data)
+        sleep_data = sleep_future.result() or {'data': []}
+        readiness_data = readiness_future.result() or {'data': []}
+        readiness_by_day = index_by_day(readiness_data)
+
+        return render_template('user_profile.html', profile=profile, sleep_data=sleep_data, readiness_by_day=readiness_by_day)
         
     except Exception as e:
-        print(f"Error in user profile: {str(e)}")
-        print(traceback.format_exc())
+        app.logger.exception("Error in user profile")
         return f'Error fetching user profile: {str(e)}', 400
 
 @app.route('/user/<path:path>')
 def serve_react(path):
     """Serve React app for user profile routes."""
-    return render_template_string('''
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <meta charset="UTF-8" />
-            <meta name="viewport" content="width=device-width, initial-scale=1.0" />
-            <title>Sleepy Panda Tracker</title>
-        </head>
-        <body>
-            <div id="root"></div>
-            <script type="module" src="/src/main.tsx"></script>
-        </body>
-        </html>
-    ''')
+    # The shell is a plain static file; it is not content-hashed, so keep its
+    # cache lifetime short instead of the year used for versioned assets
+    response = app.send_static_file('index.html')
+    response.cache_control.public = True
+    response.cache_control.max_age = REACT_SHELL_MAX_AGE
+    return response
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True) 
\ No newline at end of file
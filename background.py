@@ -0,0 +1,59 @@
+"""Background worker that ingests Oura sleep data into Supabase.
+
+Runs as a separate process (see Procfile). Each run stores every connected
+user's daily sleep scores in daily_sleep_snapshots and their aggregated
+scores in sleep_leaderboard, so the dashboard reads the leaderboard with a
+single query instead of calling Oura for every user on each page load.
+"""
+import time
+import logging
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+from core import (
+    supabase,
+    execute_read,
+    get_date_range,
+    DAILY_SLEEP_URL
+)
+from ingestion import ingest_user_sleep_safely
+
+logger = logging.getLogger(__name__)
+
+# Seconds between ingestion runs
+REFRESH_INTERVAL = 900
+# Only users active within this window are refreshed, most recent first
+ACTIVE_WINDOW = timedelta(days=30)
+MAX_REFRESH_USERS = 100
+# Concurrent per-user Oura fetches; stays below the shared session's pool size
+MAX_FETCH_WORKERS = 16
+
+def refresh_all_users() -> None:
+    """Ingest the last 7 days of sleep data for recently active connected users."""
+    start_date, end_date = get_date_range()
+    sleep_url = DAILY_SLEEP_URL.format(start_date=start_date, end_date=end_date)
+    # One timestamp for the whole run instead of one per user
+    updated_at = datetime.now(timezone.utc).isoformat()
+    
+    active_since = (datetime.now(timezone.utc) - ACTIVE_WINDOW).isoformat()
+    users = execute_read(supabase.table('profiles')\
+        .select('id, display_name, oura_tokens!inner(access_token_encrypted, refresh_token_encrypted, expires_at), sleep_leaderboard(etag, last_modified, validators_url)')\
+        .gte('last_active_at', active_since)\
+        .order('last_active_at', desc=True)\
+        .limit(MAX_REFRESH_USERS))
+    
+    # The inner join keeps disconnected profiles out of the limit, so every
+    # returned user has a token
+    with ThreadPoolExecutor(max_workers=MAX_FETCH_WORKERS) as executor:
+        list(executor.map(lambda user: ingest_user_sleep_safely(user, sleep_url, updated_at), users.data))
+
+def main() -> None:
+    while True:
+        try:
+            refresh_all_users()
+        except Exception:
+            logger.exception("Error during sleep ingestion")
+        time.sleep(REFRESH_INTERVAL)
+
+if __name__ == '__main__':
+    main()
@@ -1,93 +1,75 @@
-from supabase import create_client
-import os
-from dotenv import load_dotenv
 import json
-import requests
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
 import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 
-load_dotenv()
+# Tokens are Fernet-encrypted by the app; refreshing goes through the same
+# code path as the dashboard so refresh tokens are never spent twice, and
+# Oura calls share the app's pooled session
+from core import (
+    supabase,
+    oura_session,
+    oura_headers,
+    decrypt_token,
+    is_token_expired,
+    refresh_access_token,
+    RefreshTokenRejectedError,
+    TOKEN_REFRESH_MARGIN,
+    OURA_TIMEOUT,
+    DAILY_SLEEP_URL,
+    DAILY_READINESS_URL
+)
 
-supabase = create_client(os.getenv('SUPABASE_URL'), os.getenv('SUPABASE_KEY'))
+# Profiles whose tokens could not be refreshed; cleared in one batch per run
+invalid_profile_ids = set()
 
-def clear_invalid_token(supabase, profile_id):
-    print(f"\nAttempting to delete token for profile {profile_id}")
+def clear_invalid_tokens(supabase, profile_ids):
+    if not profile_ids:
+        return
+    profile_ids = list(profile_ids)
+    print(f"\nAttempting to delete tokens for profiles {profile_ids}")
     try:
         # Try direct deletion first (should work with new policy)
         result = supabase.table('oura_tokens')\
             .delete()\
-            .eq('profile_id', profile_id)\
+            .in_('profile_id', profile_ids)\
             .execute()
         print(f"Direct delete result: {result}")
         
         # Verify deletion
-        check = supabase.table('oura_tokens').select('*').eq('profile_id', profile_id).execute()
+        check = supabase.table('oura_tokens').select('profile_id').in_('profile_id', profile_ids).execute()
         print(f"Verification check result: {check}")
         
-        if len(check.data) > 0:
+        remaining = [row['profile_id'] for row in check.data]
+        for profile_id in remaining:
             print(f"Warning: Token still exists for profile {profile_id}")
             # Try function call as fallback
             try:
                 result = supabase.rpc('delete_token', {'target_profile_id': profile_id}).execute()
                 print(f"Function delete result: {result}")
-                
-                # Final verification
-                check = supabase.table('oura_tokens').select('*').eq('profile_id', profile_id).execute()
-                if len(check.data) > 0:
-                    print(f"Error: Unable to delete token for profile {profile_id}")
-                else:
-                    print(f"Success: Token deleted for profile {profile_id}")
             except Exception as e:
                 print(f"Error calling delete function: {str(e)}")
-        else:
-            print(f"Success: Token deleted for profile {profile_id}")
-    except Exception as e:
-        print(f"Error deleting token: {str(e)}")
-
-def decrypt_token(token_encrypted):
-    # Get the token directly as it's already decrypted by Supabase RLS
-    return token_encrypted
-
-def refresh_oura_token(refresh_token, profile_id):
-    try:
-        # Make request to Oura API to refresh token
-        response = requests.post(
-            'https://api.ouraring.com/oauth/token',
-            data={
-                'grant_type': 'refresh_token',
-                'refresh_token': refresh_token,
-                'client_id': os.getenv('OURA_CLIENT_ID'),
-                'client_secret': os.getenv('OURA_CLIENT_SECRET')
-            }
-        )
         
-        if response.status_code == 200:
-            token_data = response.json()
-            # Calculate new expiry time (current time + expires_in seconds)
-            expires_at = (datetime.now() + timedelta(seconds=token_data['expires_in'])).isoformat()
-            
-            # Update token in database
-            supabase.table('oura_tokens').update({
-                'access_token_encrypted': token_data['access_token'],
-                'refresh_token_encrypted': token_data['refresh_token'],
-                'expires_at': expires_at
-            }).eq('profile_id', profile_id).execute()
-            
-            print(f"Successfully refreshed token for profile {profile_id}")
-            return token_data['access_token']
-        else:
-            print(f"Failed to refresh token: {response.text}")
-            if 'invalid_grant' in response.text:
-                # Token is invalid, clear it from database
-                clear_invalid_token(supabase, profile_id)
-            return None
+        failed = set()
+        if remaining:
+            # Final verification
+            check = supabase.table('oura_tokens').select('profile_id').in_('profile_id', remaining).execute()
+            failed = {row['profile_id'] for row in check.data}
+            for profile_id in failed:
+                print(f"Error: Unable to delete token for profile {profile_id}")
+        
+        for profile_id in profile_ids:
+            if profile_id not in failed:
+                print(f"Success: Token deleted for profile {profile_id}")
     except Exception as e:
-        print(f"Error refreshing token: {str(e)}")
-        return None
+        print(f"Error deleting tokens: {str(e)}")
 
 def get_user_data():
     # Get fresh data with a direct query
-    result = supabase.table('profiles').select('*, oura_tokens(*)').execute()
+    result = supabase.table('profiles')\
+        .select('id, display_name, oura_user_id, created_at, email, oura_tokens(id, expires_at, scopes, access_token_encrypted, refresh_token_encrypted)')\
+        .execute()
     
     # Process the data to handle the oura_tokens array
     for profile in result.data:
@@ -97,116 +79,211 @@ def get_user_data():
     
     return result
 
-# Get all profiles with their tokens
-profiles_with_tokens = get_user_data()
+# Calculate date range for last 7 days
+today = date.today()
+end_date = today.isoformat()
+start_date = (today - timedelta(days=7)).isoformat()
+sleep_url = DAILY_SLEEP_URL.format(start_date=start_date, end_date=end_date)
+readiness_url = DAILY_READINESS_URL.format(start_date=start_date, end_date=end_date)
 
-print("\nAll Users Data:")
-print("-" * 80)
+# Profiles are fetched concurrently; kept low to stay within Oura's rate limit
+MAX_FETCH_WORKERS = 10
 
-# Calculate date range for last 7 days
-end_date = datetime.now().strftime('%Y-%m-%d')
-start_date = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d')
-
-for profile in profiles_with_tokens.data:
-    print(f"\nUser Details:")
-    print(f"  Display Name: {profile['display_name']}")
-    print(f"  User ID: {profile['id']}")
-    print(f"  Oura User ID: {profile['oura_user_id']}")
-    print(f"  Created At: {profile['created_at']}")
-    print(f"  Email: {profile['email']}")
+def fetch_profile_data(profile):
+    """Fetch a profile's sleep and readiness responses, refreshing the token on a 401."""
+    token_data = profile['oura_tokens']
+    result = {
+        'expired_status': None,
+        'sleep_response': None,
+        'readiness_response': None,
+        'sleep_data': None,
+        'readiness_data': None,
+        'refresh_failed': False,
+        'token_cleared': False,
+        'error': None
+    }
     
-    token_data = profile.get('oura_tokens')
-    if isinstance(token_data, list):
-        token_data = token_data[0] if token_data else None
+    try:
+        token = decrypt_token(token_data['access_token_encrypted'])
+        headers = oura_headers(token)
+        
+        # Get sleep data
+        sleep_response = oura_session.get(sleep_url, headers=headers, timeout=OURA_TIMEOUT)
+        
+        if sleep_response.status_code == 401:
+            result['expired_status'] = sleep_response.status_code
+            # Only a rejected or missing refresh token is dead for good; other
+            # failures may be transient, so those tokens are kept
+            token_dead = not token_data.get('refresh_token_encrypted')
+            new_token = None
+            if not token_dead:
+                try:
+                    new_token = refresh_access_token(profile['id'], token_data)
+                except RefreshTokenRejectedError:
+                    token_dead = True
+            if new_token:
+                headers = oura_headers(new_token)
+                # Retry the request with new token
+                sleep_response = oura_session.get(sleep_url, headers=headers, timeout=OURA_TIMEOUT)
+            else:
+                if token_dead:
+                    # Clear the token at the end of the run
+                    invalid_profile_ids.add(profile['id'])
+                    result['token_cleared'] = True
+                result['refresh_failed'] = True
+                return result
+        result['sleep_response'] = sleep_response
+        # Parse here so a malformed body is reported for this profile only
+        if sleep_response.status_code == 200:
+            result['sleep_data'] = sleep_response.json()
+        
+        # Get readiness data with the potentially refreshed token
+        readiness_response = oura_session.get(readiness_url, headers=headers, timeout=OURA_TIMEOUT)
+        result['readiness_response'] = readiness_response
+        if readiness_response.status_code == 200:
+            result['readiness_data'] = readiness_response.json()
+    except Exception as e:
+        result['error'] = e
+    return result
+
+def print_daily_scores(title, data):
+    """Print the daily scores and contributors from a parsed Oura collection."""
+    print(f"\n{title} Scores (last 7 days):")
+    for day in data.get('data', []):
+        print(f"  {day['day']}: {day.get('score', 'No score')}")
+        print("  Contributors:")
+        for metric, value in day.get('contributors', {}).items():
+            print(f"    {metric}: {value}")
+
+def get_expiring_tokens():
+    """Fetch only the tokens that have expired or expire within the app's TOKEN_REFRESH_MARGIN."""
+    cutoff = (datetime.now(timezone.utc) + TOKEN_REFRESH_MARGIN).isoformat()
+    return supabase.table('oura_tokens')\
+        .select('profile_id, access_token_encrypted, refresh_token_encrypted, expires_at, profiles(display_name)')\
+        .lt('expires_at', cutoff)\
+        .execute()
+
+def refresh_expiring_tokens():
+    """Refresh the tokens that are about to expire, clearing ones Oura has revoked."""
+    expiring = get_expiring_tokens()
+    print(f"\nTokens needing refresh: {len(expiring.data)}")
+    print("-" * 80)
     
-    if token_data:
-        print("\nOura Token Details:")
-        print(f"  Token ID: {token_data['id']}")
+    for token_data in expiring.data:
+        profile = token_data.get('profiles') or {}
+        print(f"\nUser: {profile.get('display_name', token_data['profile_id'])}")
         print(f"  Expires At: {token_data['expires_at']}")
-        print(f"  Scopes: {token_data['scopes'] or 'No scopes specified'}")
-        print(f"  Access Token: {token_data['access_token_encrypted'][:50]}...")
-        print(f"  Refresh Token: {token_data['refresh_token_encrypted'][:50]}...")
+        try:
+            new_token = refresh_access_token(token_data['profile_id'], token_data) if token_data.get('refresh_token_encrypted') else None
+        except RefreshTokenRejectedError:
+            # invalid_grant never recovers; clear the token at the end of the run
+            # so later runs stop posting it to Oura
+            invalid_profile_ids.add(token_data['profile_id'])
+            print("  Status: Refresh token rejected - user will need to reconnect their Oura Ring")
+            continue
+        except Exception as e:
+            print(f"  Status: Error refreshing token: {str(e)}")
+            continue
         
-        token = decrypt_token(token_data['access_token_encrypted'])
-        headers = {
-            'Authorization': f'Bearer {token}',
-            'Content-Type': 'application/json'
-        }
+        # A failed refresh may be transient; keep the token while it is still valid
+        if new_token or not is_token_expired(token_data):
+            print("  Status: Token valid")
+        else:
+            print("  Status: Token expired and could not be refreshed - will retry on the next run")
+    
+    clear_invalid_tokens(supabase, invalid_profile_ids)
+
+def run_full_scan():
+    """Print every profile with its token and Oura data, refreshing tokens that return 401."""
+    # Get all profiles with their tokens
+    profiles_with_tokens = get_user_data()
+
+    print("\nAll Users Data:")
+    print("-" * 80)
+
+    # Overlap every connected profile's Oura calls, then report in profile order
+    connected_profiles = [profile for profile in profiles_with_tokens.data if profile.get('oura_tokens')]
+    with ThreadPoolExecutor(max_workers=MAX_FETCH_WORKERS) as executor:
+        fetched = dict(zip(
+            (profile['id'] for profile in connected_profiles),
+            executor.map(fetch_profile_data, connected_profiles)
+        ))
+
+    for profile in profiles_with_tokens.data:
+        print(f"\nUser Details:")
+        print(f"  Display Name: {profile['display_name']}")
+        print(f"  User ID: {profile['id']}")
+        print(f"  Oura User ID: {profile['oura_user_id']}")
+        print(f"  Created At: {profile['created_at']}")
+        print(f"  Email: {profile['email']}")
+    
+        token_data = profile.get('oura_tokens')
+    
+        if token_data:
+            print("\nOura Token Details:")
+            print(f"  Token ID: {token_data['id']}")
+            print(f"  Expires At: {token_data['expires_at']}")
+            print(f"  Scopes: {token_data['scopes'] or 'No scopes specified'}")
+            print(f"  Access Token: {token_data['access_token_encrypted'][:50]}...")
+            print(f"  Refresh Token: {token_data['refresh_token_encrypted'][:50]}...")
         
-        try:
-            # Get sleep data
-            sleep_response = requests.get(
-                f"https://api.ouraring.com/v2/usercollection/daily_sleep?start_date={start_date}&end_date={end_date}",
-                headers=headers
-            )
-            
-            print(f"\nSleep API Response Status: {sleep_response.status_code}")
-            if sleep_response.status_code == 401:
+            result = fetched[profile['id']]
+            if result['expired_status']:
+                print(f"\nSleep API Response Status: {result['expired_status']}")
                 print("Token expired, attempting to refresh...")
-                refresh_token = decrypt_token(token_data['refresh_token_encrypted'])
-                new_token = refresh_oura_token(refresh_token, profile['id'])
-                if new_token:
-                    headers['Authorization'] = f'Bearer {new_token}'
-                    # Retry the request with new token
-                    sleep_response = requests.get(
-                        f"https://api.ouraring.com/v2/usercollection/daily_sleep?start_date={start_date}&end_date={end_date}",
-                        headers=headers
-                    )
-                else:
-                    # Clear the token immediately if refresh failed
-                    clear_invalid_token(supabase, profile['id'])
-                    print("Token refresh failed - users will need to reconnect their Oura Ring")
-                    continue  # Skip to next user since this token is invalid
+            if result['token_cleared']:
+                print("Token refresh failed - users will need to reconnect their Oura Ring")
+            elif result['refresh_failed']:
+                print("Token refresh failed - will retry on the next run")
+            else:
+                sleep_response = result['sleep_response']
+                if sleep_response is not None:
+                    print(f"\nSleep API Response Status: {sleep_response.status_code}")
+                    if sleep_response.status_code != 200:
+                        print(f"Sleep API Error: {sleep_response.text}")
+                    elif result['sleep_data'] is not None:
+                        print_daily_scores("Sleep", result['sleep_data'])
             
-            if sleep_response.status_code != 200:
-                print(f"Sleep API Error: {sleep_response.text}")
+                readiness_response = result['readiness_response']
+                if readiness_response is not None:
+                    print(f"\nReadiness API Response Status: {readiness_response.status_code}")
+                    if readiness_response.status_code != 200:
+                        print(f"Readiness API Error: {readiness_response.text}")
+                    elif result['readiness_data'] is not None:
+                        print_daily_scores("Readiness", result['readiness_data'])
             
-            if sleep_response.status_code == 200:
-                sleep_data = sleep_response.json()
-                print("\nSleep Scores (last 7 days):")
-                for day in sleep_data.get('data', []):
-                    print(f"  {day['day']}: {day.get('score', 'No score')}")
-                    print("  Contributors:")
-                    for metric, value in day.get('contributors', {}).items():
-                        print(f"    {metric}: {value}")
-            
-            # Get readiness data with the potentially refreshed token
-            readiness_response = requests.get(
-                f"https://api.ouraring.com/v2/usercollection/daily_readiness?start_date={start_date}&end_date={end_date}",
-                headers=headers
-            )
-            
-            print(f"\nReadiness API Response Status: {readiness_response.status_code}")
-            if readiness_response.status_code != 200:
-                print(f"Readiness API Error: {readiness_response.text}")
-            
-            if readiness_response.status_code == 200:
-                readiness_data = readiness_response.json()
-                print("\nReadiness Scores (last 7 days):")
-                for day in readiness_data.get('data', []):
-                    print(f"  {day['day']}: {day.get('score', 'No score')}")
-                    print("  Contributors:")
-                    for metric, value in day.get('contributors', {}).items():
-                        print(f"    {metric}: {value}")
-        except Exception as e:
-            print(f"Error fetching data: {str(e)}")
-    else:
-        print("\nNo Oura Ring connected")
+                if result['error']:
+                    print(f"Error fetching data: {str(result['error'])}")
+        else:
+            print("\nNo Oura Ring connected")
     
+        print("-" * 80)
+
+    clear_invalid_tokens(supabase, invalid_profile_ids)
+
+    # Get updated user data after all operations
+    print("\nFinal User Status:")
     print("-" * 80)
 
-# Get updated user data after all operations
-print("\nFinal User Status:")
-print("-" * 80)
-
-# Get fresh data
-final_profiles = get_user_data()
-for profile in final_profiles.data:
-    print(f"\nUser: {profile['display_name']}")
-    token_data = profile.get('oura_tokens')
-    if isinstance(token_data, list):
-        token_data = token_data[0] if token_data else None
-    if token_data:
-        print("  Status: Has Oura Ring token (needs reconnection)")
+    # Get fresh data
+    final_profiles = get_user_data()
+    for profile in final_profiles.data:
+        print(f"\nUser: {profile['display_name']}")
+        token_data = profile.get('oura_tokens')
+        if isinstance(token_data, list):
+            token_data = token_data[0] if token_data else None
+        if token_data:
+            print("  Status: Has Oura Ring token (needs reconnection)")
+        else:
+            print("  Status: No Oura Ring connected") 
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Refresh expiring Oura tokens.')
+    parser.add_argument('--verbose', action='store_true',
+                        help='scan every profile and print its Oura data instead of only refreshing expiring tokens')
+    args = parser.parse_args()
+    
+    if args.verbose:
+        run_full_scan()
     else:
-        print("  Status: No Oura Ring connected") 
\ No newline at end of file
+        refresh_expiring_tokens()
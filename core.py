@@ -0,0 +1,249 @@
+"""Clients and token helpers shared by the web app, the background worker and check_users.
+
+Importing this module configures logging and builds the pooled Oura and
+Supabase clients once per process, without creating the Flask app.
+"""
+import os
+import logging
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener
+import requests
+import httpx
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+import orjson
+from datetime import date, datetime, timedelta, timezone
+from dotenv import load_dotenv
+from supabase import create_client, Client
+from supabase.lib.client_options import ClientOptions
+from threading import Lock
+from cachetools import TTLCache, cached
+from cachetools.keys import hashkey
+from cryptography.fernet import Fernet, MultiFernet
+
+# Load environment variables
+load_dotenv()
+
+# Logging Configuration
+# Records go onto a queue and a listener thread writes them out, so request
+# handlers never block on the output stream. LOG_LEVEL defaults to INFO.
+log_queue = queue.Queue(-1)
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)s %(name)s: %(message)s'))
+log_listener = QueueListener(log_queue, log_handler)
+root_logger = logging.getLogger()
+root_logger.addHandler(QueueHandler(log_queue))
+root_logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+log_listener.start()
+atexit.register(log_listener.stop)
+# httpx logs every Supabase/PostgREST request at INFO; keep those off the hot path
+for noisy_logger in ('httpx', 'httpcore'):
+    logging.getLogger(noisy_logger).setLevel(logging.WARNING)
+
+logger = logging.getLogger(__name__)
+
+# OAuth2 client credentials, also used to refresh stored tokens
+client_id = os.getenv('OURA_CLIENT_ID')
+client_secret = os.getenv('OURA_CLIENT_SECRET')
+
+# Oura HTTP Configuration
+# A shared session keeps TLS connections to api.ouraring.com alive across calls
+OURA_TIMEOUT = (3, 10)  # (connect, read) seconds
+# Each gevent worker serves many requests at once, and each dashboard render
+# issues three Oura calls, so size the pool for that concurrency
+OURA_POOL_MAXSIZE = 64
+oura_session = requests.Session()
+# Transient failures on idempotent GETs are retried with backoff on pooled connections
+oura_retry = Retry(
+    total=3,
+    backoff_factor=0.3,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset(['GET'])
+)
+oura_session.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=OURA_POOL_MAXSIZE, max_retries=oura_retry))
+
+# Set OURA_HTTP_DEBUG to log connection pool activity and confirm that the
+# token exchange and follow-up Oura calls reuse the same connection
+if os.getenv('OURA_HTTP_DEBUG'):
+    logging.getLogger('urllib3.connectionpool').setLevel(logging.DEBUG)
+
+# Static part of every Oura API request's headers
+OURA_BASE_HEADERS = {'Content-Type': 'application/json'}
+OURA_AUTH_HEADER = 'Bearer {}'
+
+# Oura API endpoints
+OURA_TOKEN_URL = "https://api.ouraring.com/oauth/token"
+PERSONAL_INFO_URL = "https://api.ouraring.com/v2/usercollection/personal_info"
+DAILY_SLEEP_URL = "https://api.ouraring.com/v2/usercollection/daily_sleep?start_date={start_date}&end_date={end_date}"
+DAILY_READINESS_URL = "https://api.ouraring.com/v2/usercollection/daily_readiness?start_date={start_date}&end_date={end_date}"
+
+# Tokens expiring within this margin are refreshed before they are used
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+# Striped locks so concurrent requests don't spend the same refresh token;
+# a fixed pool keeps memory bounded however many profiles are refreshed
+TOKEN_REFRESH_LOCK_STRIPES = 64
+token_refresh_locks = [Lock() for _ in range(TOKEN_REFRESH_LOCK_STRIPES)]
+
+class RefreshTokenRejectedError(Exception):
+    """Oura answered invalid_grant: the stored refresh token can never be used again."""
+
+# Encryption Configuration
+# ENCRYPTION_KEYS is a comma-separated list, newest first: new tokens are
+# encrypted with the first key and any listed key can decrypt, which allows
+# key rotation without re-encrypting stored rows. ENCRYPTION_KEY still works.
+encryption_keys = os.getenv('ENCRYPTION_KEYS') or os.getenv('ENCRYPTION_KEY')
+fernet = MultiFernet([Fernet(key.strip().encode()) for key in encryption_keys.split(',')])
+# Decrypted tokens are kept in-process for a few minutes, keyed by ciphertext
+DECRYPT_CACHE_TTL = 300
+token_cache = TTLCache(maxsize=10000, ttl=DECRYPT_CACHE_TTL)
+token_cache_lock = Lock()
+
+# Supabase Configuration
+supabase: Client = create_client(
+    os.getenv('SUPABASE_URL'),
+    os.getenv('SUPABASE_KEY'),
+    options=ClientOptions(postgrest_client_timeout=10)
+)
+
+def use_pooled_postgrest_session(client: Client) -> None:
+    """Replace PostgREST's httpx client with a persistent HTTP/2 connection pool."""
+    postgrest = client.postgrest
+    default_session = postgrest.session
+    postgrest.session = httpx.Client(
+        base_url=default_session.base_url,
+        headers=default_session.headers,
+        timeout=default_session.timeout,
+        # transport retries only cover failed connects; see execute_read for
+        # pooled connections the server has already closed
+        transport=httpx.HTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+            retries=2
+        )
+    )
+    default_session.close()
+
+use_pooled_postgrest_session(supabase)
+
+def execute_read(query):
+    """Execute an idempotent PostgREST read, retrying once on a dropped pooled connection."""
+    try:
+        return query.execute()
+    except (httpx.RemoteProtocolError, httpx.ReadError):
+        # The server closed a keep-alive connection under us; the retry opens a fresh one
+        logger.info("Retrying Supabase read after a dropped connection")
+        return query.execute()
+
+def encrypt_token(token: str) -> str:
+    """Encrypt a token using Fernet encryption."""
+    return fernet.encrypt(token.encode()).decode()
+
+@cached(cache=token_cache, lock=token_cache_lock)
+def decrypt_token(encrypted_token: str) -> str:
+    """Decrypt a token using Fernet encryption, cached per ciphertext for DECRYPT_CACHE_TTL."""
+    return fernet.decrypt(encrypted_token.encode()).decode()
+
+def remember_decrypted_token(encrypted_token: str, token: str) -> None:
+    """Prime the decrypt cache with a token whose plaintext is already in hand."""
+    with token_cache_lock:
+        token_cache[hashkey(encrypted_token)] = token
+
+def oura_headers(access_token: str) -> dict:
+    """Build Oura API request headers for the given access token."""
+    return {**OURA_BASE_HEADERS, 'Authorization': OURA_AUTH_HEADER.format(access_token)}
+
+def get_date_range(days: int = 7):
+    """Return (start_date, end_date) ISO strings for the last `days` days."""
+    today = date.today()
+    return (today - timedelta(days=days)).isoformat(), today.isoformat()
+
+def get_embedded_row(record: dict, relation: str):
+    """Return a one-to-one embedded row, whether PostgREST sent a list or an object."""
+    rows = record.get(relation)
+    if isinstance(rows, list):
+        return rows[0] if rows else None
+    return rows
+
+def get_token_row(profile: dict):
+    """Return a profile's embedded oura_tokens row."""
+    return get_embedded_row(profile, 'oura_tokens')
+
+def is_token_expired(token_row: dict, margin: timedelta = timedelta(0)) -> bool:
+    """Check whether a stored oura_tokens row expires within `margin` of now."""
+    expires_at = datetime.fromisoformat(token_row['expires_at'].replace('Z', '+00:00'))
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    return expires_at <= datetime.now(timezone.utc) + margin
+
+def get_stored_token_row(profile_id: str):
+    """Re-read a profile's oura_tokens row, e.g. after another process refreshed it."""
+    result = execute_read(supabase.table('oura_tokens')\
+        .select('access_token_encrypted, refresh_token_encrypted, expires_at')\
+        .eq('profile_id', profile_id))
+    return result.data[0] if result.data else None
+
+def refresh_access_token(profile_id: str, token_row: dict):
+    """Exchange a stored refresh token for new Oura tokens and save them."""
+    # Refresh tokens are single-use: run one refresh per profile at a time in
+    # this process, and let other processes win races via the checks below
+    with token_refresh_locks[hash(profile_id) % TOKEN_REFRESH_LOCK_STRIPES]:
+        # The dashboard, profile views, the worker and check_users may all be
+        # holding the same row; use the stored tokens if one already refreshed it
+        current = get_stored_token_row(profile_id)
+        if current is None:
+            return None
+        if current['refresh_token_encrypted'] != token_row['refresh_token_encrypted'] and not is_token_expired(current, TOKEN_REFRESH_MARGIN):
+            return decrypt_token(current['access_token_encrypted'])
+        token_row = current
+        
+        response = oura_session.post(OURA_TOKEN_URL, data={
+            'grant_type': 'refresh_token',
+            'refresh_token': decrypt_token(token_row['refresh_token_encrypted']),
+            'client_id': client_id,
+            'client_secret': client_secret
+        }, timeout=OURA_TIMEOUT)
+        if response.status_code != 200:
+            if 'invalid_grant' in response.text:
+                # Another process spent this refresh token first; pick up what it stored
+                current = get_stored_token_row(profile_id)
+                if current and current['refresh_token_encrypted'] != token_row['refresh_token_encrypted']:
+                    return decrypt_token(current['access_token_encrypted'])
+                raise RefreshTokenRejectedError(f"Oura rejected the refresh token for profile {profile_id}")
+            logger.warning("Failed to refresh token for profile %s: %s", profile_id, response.text)
+            return None
+        
+        token_dict = orjson.loads(response.content)
+        access_token_encrypted = encrypt_token(token_dict['access_token'])
+        # Compare-and-swap: only replace the row that still holds the refresh token we used
+        result = supabase.table('oura_tokens').update({
+            'access_token_encrypted': access_token_encrypted,
+            'refresh_token_encrypted': encrypt_token(token_dict['refresh_token']) if token_dict.get('refresh_token') else token_row['refresh_token_encrypted'],
+            'expires_at': (datetime.now(timezone.utc) + timedelta(seconds=token_dict['expires_in'])).isoformat()
+        }, count='exact', returning='minimal')\
+            .eq('profile_id', profile_id)\
+            .eq('refresh_token_encrypted', token_row['refresh_token_encrypted'])\
+            .execute()
+        if not result.count:
+            # The row changed underneath us (e.g. a reconnect); keep the newer tokens
+            logger.info("Tokens for profile %s changed during refresh; not overwriting", profile_id)
+        
+        remember_decrypted_token(access_token_encrypted, token_dict['access_token'])
+        return token_dict['access_token']
+
+def get_valid_access_token(profile_id: str, token_row: dict):
+    """Return a usable access token, refreshing it first if it is about to expire."""
+    if is_token_expired(token_row, TOKEN_REFRESH_MARGIN) and token_row.get('refresh_token_encrypted'):
+        try:
+            access_token = refresh_access_token(profile_id, token_row)
+            if access_token:
+                return access_token
+        except RefreshTokenRejectedError as e:
+            logger.warning("%s", e)
+        except Exception:
+            logger.exception("Error refreshing token for profile %s", profile_id)
+    
+    # Fall back to the stored token while it is still valid
+    if is_token_expired(token_row):
+        return None
+    return decrypt_token(token_row['access_token_encrypted'])
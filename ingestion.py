@@ -0,0 +1,129 @@
+"""Ingest a user's Oura sleep data into daily_sleep_snapshots and sleep_leaderboard.
+
+Used by the background worker for every recently active user, and by the
+web app to seed a user's scores as soon as they connect their Oura Ring.
+"""
+import logging
+import orjson
+from datetime import datetime, timezone
+
+from core import (
+    supabase,
+    oura_session,
+    oura_headers,
+    get_date_range,
+    get_embedded_row,
+    get_token_row,
+    get_valid_access_token,
+    DAILY_SLEEP_URL,
+    OURA_TIMEOUT
+)
+
+logger = logging.getLogger(__name__)
+
+def summarise_sleep_scores(daily_scores: list) -> dict:
+    """Compute latest score, average score and day count from (day, score) pairs."""
+    # Single pass: keep a running total and track the newest scored day
+    total = 0
+    num_days = 0
+    latest_day = None
+    latest_score = 0
+    
+    for day, score in daily_scores:
+        if score is None:
+            continue
+        total += score
+        num_days += 1
+        if latest_day is None or day > latest_day:
+            latest_day, latest_score = day, score
+    
+    return {
+        'latest_score': int(latest_score),  # Most recent score
+        'avg_score': round(total / num_days, 1) if num_days else 0,
+        'num_days': num_days  # Track how many days of data we have
+    }
+
+def ingest_user_sleep(user: dict, sleep_url: str, updated_at: str) -> None:
+    """Fetch a user's daily sleep from Oura and store snapshots and leaderboard scores."""
+    token_row = get_token_row(user)
+    
+    # Refresh tokens that are about to expire; if that fails the call would
+    # only earn a 401, so leave the user's last stored scores in place
+    token = get_valid_access_token(user['id'], token_row)
+    if token is None:
+        logger.info("Skipping %s: Oura token expired at %s", user['display_name'], token_row['expires_at'])
+        return
+    
+    # Send the validators from the last successful fetch so Oura can answer
+    # 304 Not Modified when nothing changed. They only describe the URL they
+    # came from, so drop them once the date window has moved on
+    headers = oura_headers(token)
+    previous = get_embedded_row(user, 'sleep_leaderboard') or {}
+    if previous.get('validators_url') == sleep_url:
+        if previous.get('etag'):
+            headers['If-None-Match'] = previous['etag']
+        if previous.get('last_modified'):
+            headers['If-Modified-Since'] = previous['last_modified']
+    
+    sleep_response = oura_session.get(
+        sleep_url,
+        headers=headers,
+        timeout=OURA_TIMEOUT
+    )
+    
+    if sleep_response.status_code == 304:
+        # Stored snapshots and scores are still current; only mark them as
+        # refreshed so the dashboard keeps showing this user
+        supabase.table('sleep_leaderboard')\
+            .update({'updated_at': updated_at}, returning='minimal')\
+            .eq('profile_id', user['id'])\
+            .execute()
+        return
+    
+    if sleep_response.status_code != 200:
+        logger.warning("Failed to fetch sleep data for %s: %s", user['display_name'], sleep_response.text)
+        return
+    
+    sleep_data = orjson.loads(sleep_response.content)
+    # Debug info to understand data structure, only rendered when DEBUG is on
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Sleep data for %s: %s", user['display_name'], sleep_data)
+    
+    # Only the day and score are needed; drop contributors and other fields
+    daily_scores = [(day['day'], day.get('score')) for day in sleep_data.get('data', [])]
+    snapshots = [
+        {
+            'profile_id': user['id'],
+            'day': day,
+            'score': score,
+            'updated_at': updated_at
+        }
+        for day, score in daily_scores
+    ]
+    
+    if snapshots:
+        supabase.table('daily_sleep_snapshots')\
+            .upsert(snapshots, on_conflict='profile_id,day', returning='minimal')\
+            .execute()
+    
+    supabase.table('sleep_leaderboard').upsert({
+        'profile_id': user['id'],
+        **summarise_sleep_scores(daily_scores),
+        'etag': sleep_response.headers.get('ETag'),
+        'last_modified': sleep_response.headers.get('Last-Modified'),
+        'validators_url': sleep_url,
+        'updated_at': updated_at
+    }, on_conflict='profile_id', returning='minimal').execute()
+
+def ingest_user_sleep_safely(user: dict, sleep_url: str, updated_at: str) -> None:
+    """Ingest one user's sleep data, logging instead of raising on failure."""
+    try:
+        ingest_user_sleep(user, sleep_url, updated_at)
+    except Exception:
+        logger.exception("Error fetching data for user %s", user['display_name'])
+
+def ingest_new_user(user: dict) -> None:
+    """Ingest one user's sleep data outside the regular refresh loop."""
+    start_date, end_date = get_date_range()
+    sleep_url = DAILY_SLEEP_URL.format(start_date=start_date, end_date=end_date)
+    ingest_user_sleep_safely(user, sleep_url, datetime.now(timezone.utc).isoformat())